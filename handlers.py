@@ -1,116 +1,286 @@
 # handlers.py
 # Moduli di handler per i vari "servizi" dell'honeypot.
-# Ogni handler è una coroutine che riceve (reader, writer, ctx) come asyncio streams.
+# Ogni handler è una coroutine che riceve (reader, writer, ctx) come asyncio streams,
+# tranne il TCP generico che è un asyncio.BufferedProtocol (GenericProto).
 
 import asyncio
-from datetime import datetime
-import json
-import binascii
+import re
+import time
 
-async def log_interaction(ctx, role, data_bytes):
-    # ctx contiene: logger (callable or object), peer, port, service
-    ts = datetime.utcnow().isoformat()
+# Timestamp ISO 8601 (UTC, microsecondi) come datetime.utcnow().isoformat(), ma
+# la parte fino ai secondi viene formattata al massimo una volta al secondo.
+_last_sec = None
+_last_sec_str = ""
+
+def utc_timestamp():
+    global _last_sec, _last_sec_str
+    ns = time.time_ns()
+    sec = ns // 1_000_000_000
+    if sec != _last_sec:
+        _last_sec = sec
+        _last_sec_str = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+    return f"{_last_sec_str}.{(ns % 1_000_000_000) // 1000:06d}"
+
+# Ctx: contesto di una connessione. Classe con __slots__ invece di un dict
+# copiato per ogni connessione: creazione e accesso agli attributi più economici.
+class Ctx:
+    __slots__ = ("logger", "peer", "peer_port", "service", "log_text")
+
+    def __init__(self, logger, peer=None, peer_port=None, service=None, log_text=False):
+        self.logger = logger
+        self.peer = peer
+        self.peer_port = peer_port
+        self.service = service
+        self.log_text = log_text
+
+def log_interaction(ctx, role, data_bytes, ts=None):
+    # ctx è un Ctx (logger, peer, peer_port, service, log_text)
+    # data_bytes può essere bytes o memoryview: viene consumato subito
+    # ts: timestamp già calcolato (es. arrivo del primo chunk), altrimenti adesso
     record = {
-        "ts": ts,
+        "ts": ts or utc_timestamp(),
         "role": role,            # "client" o "server"
-        "peer": ctx.get("peer"),
-        "peer_port": ctx.get("peer_port"),
-        "service": ctx.get("service"),
-        "raw_hex": binascii.hexlify(data_bytes).decode(),
+        "peer": ctx.peer,
+        "peer_port": ctx.peer_port,
+        "service": ctx.service,
+        "raw_hex": data_bytes.hex(),
         "raw_text": None
     }
-    # prova a decodificare in utf-8 (non obbligatorio)
+    # decodifica in utf-8 solo se richiesto (servizi testuali, es. HTTP)
+    if ctx.log_text:
+        record["raw_text"] = str(data_bytes, "utf-8", errors="replace")
+    # accoda al logger (non blocca: la scrittura su file avviene in honeypot.log_writer)
+    ctx.logger(record)
+
+# FrameBuffer: riassemblaggio di protocolli a frame con header di lunghezza.
+# Tiene un offset di lettura e compatta il buffer una sola volta alla fine del
+# drain, evitando il costo O(N^2) di buf = buf[n:] ad ogni frame.
+class FrameBuffer:
+    def __init__(self):
+        self.buf = bytearray()
+        self.offset = 0
+
+    def append(self, data):
+        self.buf += data
+
+    def drain_frames(self, hdr_len, parse_hdr):
+        # parse_hdr(header) -> lunghezza del payload che segue l'header.
+        # I frame sono memoryview su self.buf validi solo fino al frame
+        # successivo: copiarli con bytes() se servono più a lungo.
+        buf = self.buf
+        mv = memoryview(buf)
+        try:
+            while len(buf) - self.offset >= hdr_len:
+                start = self.offset + hdr_len
+                with mv[self.offset:start] as hdr:
+                    expected = parse_hdr(hdr)
+                if len(buf) - start < expected:
+                    break
+                frame = mv[start:start + expected]
+                self.offset = start + expected
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+        finally:
+            mv.release()
+            del buf[:self.offset]
+            self.offset = 0
+
+# read() con scadenza: un solo TimerHandle (niente Task/Future aggiuntivi come in
+# wait_for). on_deadline deve far terminare la read() in attesa: writer.close per
+# chiudere la connessione, end_input per smettere di leggere ma poter ancora rispondere.
+async def read_with_deadline(reader, n, timeout, on_deadline):
+    deadline = asyncio.get_running_loop().call_later(timeout, on_deadline)
     try:
-        record["raw_text"] = data_bytes.decode("utf-8", errors="replace")
-    except Exception:
-        pass
-    # scrivi con il logger (funzione o oggetto)
-    logger = ctx.get("logger")
-    if callable(logger):
-        logger(record)
-    else:
-        # fallback: append su file jsonl
-        with open("logs/interactions.jsonl", "a") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return await reader.read(n)
+    finally:
+        deadline.cancel()
 
-# HTTP handler: semplice server che risponde con pagina statica
-HTTP_RESPONSE = b"""HTTP/1.1 200 OK
-Content-Type: text/html; charset=utf-8
-Content-Length: {length}
+def end_input(reader, writer):
+    # niente più dati in ingresso (pause_reading evita feed_data dopo feed_eof):
+    # read() restituisce quanto già ricevuto o b"", la connessione resta aperta
+    writer.transport.pause_reading()
+    reader.feed_eof()
 
-{body}
-"""
+# HTTP handler: semplice server che risponde con pagina statica
+# la risposta è costante: viene costruita una sola volta all'import
+_HTTP_BODY = b"<html><body><h1>Welcome</h1><p>This is a honeypot HTTP page.</p></body></html>"
+HTTP_RESPONSE_BYTES = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/html; charset=utf-8\r\n"
+    b"Content-Length: " + str(len(_HTTP_BODY)).encode() + b"\r\n"
+    b"\r\n" + _HTTP_BODY
+)
 
 async def http_handler(reader, writer, ctx):
-    peer = writer.get_extra_info("peername")
-    ctx["peer"], ctx["peer_port"] = peer[0], peer[1] if peer else (None, None)
-    ctx["service"] = "http"
+    ctx.service = "http"
+    ctx.log_text = True
     # ricevi prima porzione (non reassembly)
-    try:
-        data = await asyncio.wait_for(reader.read(4096), timeout=3.0)
-    except asyncio.TimeoutError:
-        data = b""
+    # alla scadenza si risponde comunque con la pagina, come un server lento
+    data = await read_with_deadline(reader, 4096, 3.0, lambda: end_input(reader, writer))
     if data:
-        await log_interaction(ctx, "client", data)
-    body = "<html><body><h1>Welcome</h1><p>This is a honeypot HTTP page.</p></body></html>"
-    resp = HTTP_RESPONSE.format(length=len(body), body=body).encode()
-    await log_interaction(ctx, "server", resp)
-    writer.write(resp)
-    try:
-        await writer.drain()
-    except:
-        pass
+        log_interaction(ctx, "client", data)
+    # se il client ha già chiuso la connessione non c'è nessuno a cui rispondere
+    if not writer.is_closing():
+        resp = HTTP_RESPONSE_BYTES
+        log_interaction(ctx, "server", resp)
+        # risposta breve e unica: niente drain(), close() svuota il buffer prima di chiudere
+        writer.write(resp)
     writer.close()
     try:
         await writer.wait_closed()
-    except:
+    except OSError:
         pass
 
 # Banner handler: simula servizi come SSH/Telnet inviando un banner e registrando input
-async def banner_handler(reader, writer, ctx, banner=b"SSH-2.0-OpenSSH_7.4\r\n"):
-    peer = writer.get_extra_info("peername")
-    ctx["peer"], ctx["peer_port"] = peer[0], peer[1] if peer else (None, None)
-    ctx["service"] = "banner"
-    # invia banner
-    try:
-        writer.write(banner)
-        await writer.drain()
-        await log_interaction(ctx, "server", banner)
-    except:
-        pass
+DEFAULT_BANNER = b"SSH-2.0-OpenSSH_7.4\r\n"
+
+# "\\" (backslash letterale) va riconosciuto prima di "\xNN", così "\\x41" resta testo
+_BANNER_HEX_ESCAPE = re.compile(r"\\\\|\\x([0-9a-fA-F]{2})")
+
+def _unescape_utf8(text):
+    # escape di Python (\r, \n, \uXXXX, ...) -> testo codificato in UTF-8.
+    # backslashreplace trasforma i caratteri oltre latin-1 in \uXXXX, che
+    # unicode_escape poi rilegge: il testo non ASCII non viene alterato.
+    return text.encode("latin-1", "backslashreplace").decode("unicode_escape").encode("utf-8")
+
+def decode_banner(text):
+    # banner dal config con sequenze di escape testuali (es. \r\n, \xff) -> bytes da inviare.
+    # Solo gli escape \xNN diventano byte singoli (per banner binari); tutto il resto,
+    # inclusi \uXXXX/\UXXXXXXXX e i caratteri non ASCII, viene inviato in UTF-8
+    # (es. "\u00e9" -> c3 a9, "\xe9" -> e9).
+    out = bytearray()
+    pos = 0
+    for m in _BANNER_HEX_ESCAPE.finditer(text):
+        if m.group(1) is None:
+            continue
+        out += _unescape_utf8(text[pos:m.start()])
+        out.append(int(m.group(1), 16))
+        pos = m.end()
+    out += _unescape_utf8(text[pos:])
+    return bytes(out)
+
+async def banner_handler(reader, writer, ctx, banner=DEFAULT_BANNER):
+    ctx.service = "banner"
+    # invia banner (senza drain(): il transport lo spedisce appena possibile)
+    writer.write(banner)
+    log_interaction(ctx, "server", banner)
     # legge i primi N byte (timeout)
-    try:
-        data = await asyncio.wait_for(reader.read(2048), timeout=10.0)
-    except asyncio.TimeoutError:
-        data = b""
+    data = await read_with_deadline(reader, 2048, 10.0, writer.close)
     if data:
-        await log_interaction(ctx, "client", data)
+        log_interaction(ctx, "client", data)
     # optionally respond with nothing and close connection
     writer.close()
     try:
         await writer.wait_closed()
-    except:
+    except OSError:
         pass
 
-# Generic TCP handler: echo-like but with logging (non echoing by default)
-async def generic_tcp_handler(reader, writer, ctx, echo=False):
-    peer = writer.get_extra_info("peername")
-    ctx["peer"], ctx["peer_port"] = peer[0], peer[1] if peer else (None, None)
-    ctx["service"] = ctx.get("service", "tcp")
-    try:
-        while True:
-            data = await reader.read(4096)
-            if not data:
-                break
-            await log_interaction(ctx, "client", data)
-            if echo:
-                writer.write(data)
-                await writer.drain()
-    except Exception:
-        pass
-    finally:
-        writer.close()
+# Generic TCP handler: echo-like but with logging (non echoing by default).
+# E' un Protocol bufferizzato invece di una coroutine su streams: il kernel
+# scrive direttamente nel buffer di ricezione (recv_into), senza la copia
+# intermedia di StreamReader.
+RECV_BUFFER_SIZE = 1 << 16
+
+# Buffer di ricezione condiviso: get_buffer() e buffer_updated() avvengono nella
+# stessa callback dell'event loop e i dati vengono consumati subito, quindi un
+# solo buffer basta per tutte le connessioni (niente 64 KiB per connessione).
+_recv_buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+
+# I chunk di una connessione vengono accumulati e registrati come un solo record
+# dopo COALESCE_DELAY secondi dal primo chunk o appena superano COALESCE_BYTES.
+COALESCE_DELAY = 0.1
+COALESCE_BYTES = 1 << 14
+
+# connessioni GenericProto aperte: all'arresto i chunk ancora in attesa vanno
+# registrati anche se connection_lost non viene chiamato (vedi flush_all_pending)
+_generic_conns = set()
+
+def flush_all_pending():
+    for proto in list(_generic_conns):
+        proto.flush_pending()
+
+class GenericProto(asyncio.BufferedProtocol):
+    def __init__(self, ctx, echo=False):
+        self.ctx = ctx
+        self.echo = echo
+        self.transport = None
+        self.loop = None
+        self.pending = bytearray()
+        self.pending_ts = None
+        self.flush_handle = None
+        self.port = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        _generic_conns.add(self)
+        sock = transport.get_extra_info("sockname")
+        self.port = sock[1] if sock else None
+        # passthrough: nessun accumulo di dati in uscita nel transport
+        transport.set_write_buffer_limits(high=0)
+        peer = transport.get_extra_info("peername")
+        if peer:
+            self.ctx.peer, self.ctx.peer_port = peer[0], peer[1]
+        if self.ctx.service is None:
+            self.ctx.service = "tcp"
+
+    def get_buffer(self, sizehint):
+        return _recv_buffer
+
+    def buffer_updated(self, nbytes):
         try:
-            await writer.wait_closed()
-        except:
-            pass
+            data = _recv_buffer[:nbytes]
+            if self.echo:
+                self.transport.write(bytes(data))
+            if not self.pending:
+                # il record coalescente porta l'orario del primo chunk
+                self.pending_ts = utc_timestamp()
+            self.pending += data
+            if len(self.pending) >= COALESCE_BYTES:
+                self.flush_pending()
+            elif self.flush_handle is None:
+                self.flush_handle = self.loop.call_later(COALESCE_DELAY, self.flush_pending)
+        except Exception as e:
+            self.handler_exception(e)
+            self.transport.close()
+
+    def flush_pending(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending:
+            try:
+                log_interaction(self.ctx, "client", self.pending, ts=self.pending_ts)
+            except Exception as e:
+                self.handler_exception(e)
+            del self.pending[:]
+
+    def handler_exception(self, e):
+        # stesso record degli handler su streams (vedi honeypot.start_listener)
+        record = {
+            "ts": utc_timestamp(),
+            "event": "handler_exception",
+            "port": self.port,
+            "handler": "generic",
+            "error": str(e)
+        }
+        self.ctx.logger(record)
+
+    # backpressure per l'echo: con high=0 il transport chiede la pausa appena
+    # resta qualcosa da inviare; si smette di leggere finché il client non legge
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def eof_received(self):
+        # il client ha chiuso in scrittura: chiudiamo anche noi
+        return False
+
+    def connection_lost(self, exc):
+        _generic_conns.discard(self)
+        self.flush_pending()
+        self.transport = None
@@ -5,13 +5,29 @@
 
 import argparse
 import asyncio
+import atexit
 import os
 import json
-from datetime import datetime
+import socket
+import sys
+import time
+from functools import partial
 from importlib import import_module
 import handlers
 import signal
 
+# orjson (opzionale) serializza molto più velocemente e restituisce già bytes UTF-8
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
 DEFAULT_CONFIG = {
     "listeners": [
         {"port": 80,  "proto": "tcp", "handler": "http"},
@@ -22,58 +38,191 @@ DEFAULT_CONFIG = {
     "jsonl": True
 }
 
+# handler su streams per nome; "generic" (e ogni nome non presente) usa handlers.GenericProto
+HANDLERS = {
+    "http": handlers.http_handler,
+    "banner": handlers.banner_handler,
+}
+
 SERVERS = []
+LOG_TASK = None
+# attesa massima per la chiusura dei listener (e dei worker) all'arresto
+SHUTDOWN_TIMEOUT = 5.0
+
+# coda di accept ampia per reggere raffiche di SYN; con SO_REUSEPORT (solo se
+# --workers > 1) più processi ascoltano sulle stesse porte e il kernel distribuisce
+# le connessioni. Con un solo worker resta attivo il controllo "porta già in uso".
+LISTEN_BACKLOG = 4096
+HAS_REUSE_PORT = hasattr(socket, "SO_REUSEPORT")
+# solo su Linux (e DragonFly) SO_REUSEPORT bilancia le accept() TCP tra i processi;
+# su macOS/BSD la porta si condivide ma le connessioni vanno quasi tutte a un worker
+BALANCED_REUSE_PORT = HAS_REUSE_PORT and sys.platform.startswith(("linux", "dragonfly"))
+
+# log su file: gli handler accodano i record, un solo task li scrive a batch
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+# massimo numero di buffer per singola writev() (IOV_MAX su Linux)
+LOG_IOV_MAX = 1024
+# oltre questa dimensione il file viene ruotato (sovrascrivibile con "log_max_bytes")
+LOG_MAX_BYTES = 256 << 20
 
 def ensure_logdir(path):
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
 
-def jsonl_logger_factory(path):
+class RotatingJsonl:
+    # file jsonl aperto una sola volta per processo; superati max_bytes viene
+    # rinominato in <path>.<unix time> e se ne apre uno nuovo
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.f = open(path, "ab")
+        self.bytes_written = self.f.tell()
+
+    def write_batch(self, parts):
+        # scatter-gather: una sola syscall per gruppo di buffer, senza concatenarli
+        f = self.f
+        if not hasattr(os, "writev"):
+            data = b"".join(parts)
+            f.write(data)
+            f.flush()
+            self.bytes_written += len(data)
+        else:
+            fd = f.fileno()
+            for i in range(0, len(parts), LOG_IOV_MAX):
+                chunk = parts[i:i + LOG_IOV_MAX]
+                written = os.writev(fd, chunk)
+                size = sum(map(len, chunk))
+                if written < size:
+                    # scrittura parziale (rara su file regolari): completa il resto
+                    f.write(b"".join(chunk)[written:])
+                    f.flush()
+                self.bytes_written += size
+        if self.bytes_written >= self.max_bytes:
+            try:
+                self.rotate()
+            except OSError as e:
+                # il batch è già scritto: si continua sul file corrente
+                print(f"Errore rotazione log: {e}", file=sys.stderr)
+
+    def rotate(self):
+        # il vecchio handle resta aperto finché il nuovo file non è pronto: se la
+        # rename o l'open falliscono si continua sul file corrente e si ritenta
+        # la rotazione al batch successivo
+        stamp = int(time.time())
+        while os.path.exists(f"{self.path}.{stamp}"):
+            stamp += 1
+        rotated = f"{self.path}.{stamp}"
+        os.rename(self.path, rotated)
+        try:
+            f = open(self.path, "ab")
+        except OSError:
+            # riporta il file al nome originale (l'handle aperto punta ancora a lui)
+            os.rename(rotated, self.path)
+            raise
+        self.f.close()
+        self.f = f
+        self.bytes_written = 0
+
+    def reopen(self):
+        # dopo un errore che ha lasciato il file chiuso
+        self.f = open(self.path, "ab")
+        self.bytes_written = self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+def open_jsonl(path, max_bytes=LOG_MAX_BYTES, worker=0):
     ensure_logdir(path)
-    filename = os.path.join(path, "interactions.jsonl")
-    # ensure file exists
-    open(filename, "a").close()
+    # ogni worker ha il proprio file, così la rotazione non va coordinata tra processi
+    name = "interactions.jsonl" if worker == 0 else f"interactions.{worker}.jsonl"
+    sink = RotatingJsonl(os.path.join(path, name), max_bytes)
+    atexit.register(sink.close)
+    return sink
+
+def jsonl_logger_factory(queue):
+    # il logger non tocca il disco: accoda e torna subito all'event loop
     def logger(record):
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if queue.full():
+            # coda piena: scarta il record più vecchio
+            queue.get_nowait()
+        queue.put_nowait(record)
     return logger
 
-async def start_listener(bind_host, listener, logger):
+def write_batch_safe(sink, parts):
+    # un errore di scrittura (disco pieno, EIO, file chiuso) perde solo il
+    # batch corrente: viene segnalato e il writer continua con i record successivi
+    try:
+        sink.write_batch(parts)
+    except (OSError, ValueError) as e:
+        print(f"Errore scrittura log ({len(parts) // 2} record persi): {e}", file=sys.stderr)
+        if sink.f.closed:
+            try:
+                sink.reopen()
+            except OSError as e:
+                print(f"Errore riapertura log: {e}", file=sys.stderr)
+
+async def log_writer(queue, sink):
+    # ogni record diventa due buffer (json, newline) passati insieme a sink.write_batch
+    parts = []
+    try:
+        while True:
+            # attende il primo record, poi prende quelli già in coda (fino a LOG_BATCH_SIZE)
+            record = await queue.get()
+            while True:
+                parts.append(_dumps(record))
+                parts.append(b"\n")
+                if len(parts) >= 2 * LOG_BATCH_SIZE:
+                    break
+                try:
+                    record = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            write_batch_safe(sink, parts)
+            parts.clear()
+    finally:
+        # arresto: scrive quanto rimasto in coda e chiude il file
+        while not queue.empty():
+            parts.append(_dumps(queue.get_nowait()))
+            parts.append(b"\n")
+        write_batch_safe(sink, parts)
+        sink.close()
+
+async def start_listener(bind_host, listener, logger, reuse_port=False):
     port = listener.get("port")
     handler_name = listener.get("handler")
     proto = listener.get("proto", "tcp")
-    ctx_base = {"logger": logger}
-    # select handler
-    if handler_name == "http":
-        handler = handlers.http_handler
-    elif handler_name == "banner":
-        # wrapper to pass banner
-        async def h(r, w, ctx):
-            banner = listener.get("banner", "SSH-2.0-OpenSSH_7.4\r\n").encode().decode('unicode_escape').encode()
-            await handlers.banner_handler(r, w, ctx, banner=banner)
-        handler = h
-    else:
-        # generic
+    log_text = bool(listener.get("log_text", False))
+    handler = HANDLERS.get(handler_name)
+    protocol_factory = None
+    # parametri statici del listener risolti una volta sola, non ad ogni connessione
+    if handler_name == "banner":
+        banner = listener.get("banner")
+        # "banner": "" è valido (nessun banner): il default vale solo se la chiave manca
+        banner = handlers.DEFAULT_BANNER if banner is None else handlers.decode_banner(banner)
+        handler = partial(handler, banner=banner)
+    elif handler is None:
+        # generic: Protocol bufferizzato, niente streams
         echo = bool(listener.get("echo", False))
-        async def h(r, w, ctx):
-            ctx["service"] = listener.get("service", f"tcp_{port}")
-            await handlers.generic_tcp_handler(r, w, ctx, echo=echo)
-        handler = h
+        service = listener.get("service", f"tcp_{port}")
+        def protocol_factory():
+            ctx = handlers.Ctx(logger, service=service, log_text=log_text)
+            return handlers.GenericProto(ctx, echo=echo)
 
     async def client_connected(reader, writer):
-        ctx = dict(ctx_base)  # copy
-        # set peer info in handler
+        # passthrough: nessun accumulo di dati in uscita nel transport
+        writer.transport.set_write_buffer_limits(high=0)
         peer = writer.get_extra_info("peername")
         if peer:
-            ctx["peer"], ctx["peer_port"] = peer[0], peer[1]
+            ctx = handlers.Ctx(logger, peer[0], peer[1], log_text=log_text)
         else:
-            ctx["peer"], ctx["peer_port"] = None, None
+            ctx = handlers.Ctx(logger, log_text=log_text)
         try:
             await handler(reader, writer, ctx)
         except Exception as e:
             # log handler exception
             record = {
-                "ts": datetime.utcnow().isoformat(),
+                "ts": handlers.utc_timestamp(),
                 "event": "handler_exception",
                 "port": port,
                 "handler": handler_name,
@@ -82,20 +231,30 @@ async def start_listener(bind_host, listener, logger):
             logger(record)
 
     # start server
-    server = await asyncio.start_server(client_connected, bind_host, port)
+    if protocol_factory is None:
+        server = await asyncio.start_server(client_connected, bind_host, port,
+                                            backlog=LISTEN_BACKLOG, reuse_port=reuse_port)
+    else:
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(protocol_factory, bind_host, port,
+                                          backlog=LISTEN_BACKLOG, reuse_port=reuse_port)
     addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
     print(f"[+] Listening on {addrs} (handler={handler_name})")
     return server
 
-async def run_from_config(cfg, bind_host="0.0.0.0"):
+async def run_from_config(cfg, bind_host="0.0.0.0", worker=0, reuse_port=False):
     logdir = cfg.get("log_dir", "logs")
     ensure_logdir(logdir)
-    logger = jsonl_logger_factory(logdir)
+    global LOG_TASK
+    queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger = jsonl_logger_factory(queue)
+    sink = open_jsonl(logdir, cfg.get("log_max_bytes", LOG_MAX_BYTES), worker)
+    LOG_TASK = asyncio.ensure_future(log_writer(queue, sink))
     listeners = cfg.get("listeners", [])
     servers = []
     for l in listeners:
         try:
-            srv = await start_listener(bind_host, l, logger)
+            srv = await start_listener(bind_host, l, logger, reuse_port=reuse_port)
             servers.append(srv)
         except PermissionError:
             print(f"Errore: permessi insufficienti per aprire porta {l.get('port')}. Usa porta >1024 o sudo.")
@@ -113,11 +272,83 @@ def load_config(path):
             # try yaml-lite (user may supply json style)
             return json.load(f)
 
-def sigint_handler(loop):
-    print("\n[!] Arresto richiesto, chiudo server...")
-    for s in SERVERS:
+async def shutdown_all(servers):
+    # chiude tutti i listener e ne attende la chiusura in parallelo
+    for s in servers:
         s.close()
-    # stop loop later
+        if hasattr(s, "close_clients"):
+            # Python 3.13+: chiude anche le connessioni attive, che wait_closed() attenderebbe
+            s.close_clients()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(s.wait_closed() for s in servers)), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+
+def request_stop(stop):
+    if not stop.done():
+        stop.set_result(None)
+
+async def serve(cfg, bind_host="0.0.0.0", worker=0, reuse_port=False):
+    global SERVERS
+    SERVERS = await run_from_config(cfg, bind_host=bind_host, worker=worker, reuse_port=reuse_port)
+    # keep running until Ctrl+C (o SIGTERM, usato dal padre per fermare i worker)
+    print("[*] Honeypot avviato. Premi Ctrl+C per terminare.")
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, request_stop, stop)
+    except NotImplementedError:
+        # Windows: nessun handler di segnali nell'event loop
+        pass
+    try:
+        await stop
+    finally:
+        # arresto in corso: altri segnali (es. Ctrl+C arrivato a tutto il gruppo
+        # più l'inoltro del padre) non devono interrompere la pulizia
+        try:
+            loop.remove_signal_handler(signal.SIGTERM)
+        except NotImplementedError:
+            pass
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        await shutdown_all(SERVERS)
+        # chunk TCP generici ancora nella finestra di coalescenza
+        handlers.flush_all_pending()
+        if LOG_TASK is not None:
+            LOG_TASK.cancel()
+            await asyncio.gather(LOG_TASK, return_exceptions=True)
+
+def spawn_workers(n):
+    # crea n-1 processi figli; restituisce (indice del worker corrente, pid dei figli)
+    children = []
+    for i in range(1, n):
+        pid = os.fork()
+        if pid == 0:
+            return i, []
+        children.append(pid)
+    return 0, children
+
+def reap_workers(children):
+    # inoltra l'arresto ai worker (il SIGINT può essere arrivato solo al padre) con
+    # SIGTERM: chi si sta già fermando per Ctrl+C lo ignora (vedi serve), così ogni
+    # worker esegue la pulizia una volta sola. Chi è ancora attivo dopo
+    # SHUTDOWN_TIMEOUT viene terminato
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    pending = set(children)
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while pending and time.monotonic() < deadline:
+        for pid in list(pending):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                pending.discard(pid)
+        if pending:
+            time.sleep(0.05)
+    for pid in pending:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
 
 def main():
     parser = argparse.ArgumentParser(description="Honeypot-lite: crea un honeypot in pochi comandi (uso didattico)")
@@ -125,8 +356,14 @@ def main():
     parser.add_argument("-b", "--bind", default="0.0.0.0", help="Indirizzo su cui bindare (default 0.0.0.0)")
     parser.add_argument("--list", action="store_true", help="Stampa configurazione di default e esce")
     parser.add_argument("--gen-config", help="Genera un template config JSON nel path indicato e esci")
+    parser.add_argument("--workers", type=int, default=1, help="Numero di processi worker sulle stesse porte (default 1, solo Linux)")
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers deve essere almeno 1")
+    if args.workers > 1 and not (BALANCED_REUSE_PORT and hasattr(os, "fork")):
+        parser.error("--workers > 1 richiede Linux: solo lì SO_REUSEPORT distribuisce le connessioni tra i worker")
+
     if args.list:
         print(json.dumps(DEFAULT_CONFIG, indent=2))
         return
@@ -138,34 +375,22 @@ def main():
         return
 
     cfg = DEFAULT_CONFIG if not args.config else load_config(args.config)
-    loop = asyncio.get_event_loop()
-    # opzione per uvloop se installato
+    # opzione per uvloop se installato: la policy va impostata prima di creare l'event loop
     try:
         import uvloop
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-    except Exception:
+    except ImportError:
         pass
 
+    # i worker vanno creati prima dell'event loop: ognuno avvia il proprio
+    worker, children = spawn_workers(args.workers)
     try:
-        servers = loop.run_until_complete(run_from_config(cfg, bind_host=args.bind))
-        global SERVERS
-        SERVERS = servers
-        # keep running until Ctrl+C
-        print("[*] Honeypot avviato. Premi Ctrl+C per terminare.")
-        for s in servers:
-            # keep servers referenced
-            pass
-        # wait forever
-        loop.run_forever()
+        asyncio.run(serve(cfg, bind_host=args.bind, worker=worker, reuse_port=args.workers > 1))
     except KeyboardInterrupt:
         print("\n[!] Interruzione ricevuta.")
     finally:
-        for s in SERVERS:
-            s.close()
-        loop.stop()
-        loop.run_until_complete(loop.shutdown_asyncgens())
-        loop.close()
-        print("[*] Honeypot arrestato.")
+        reap_workers(children)
+    print("[*] Honeypot arrestato.")
 
 if __name__ == "__main__":
     main()